@@ -0,0 +1,330 @@
+"""
+Numba compiled kernels for the hot loops of the likelihood calculation.
+For the small numbers of states we deal with the NumPy versions spend
+most of their time in dispatch overhead, so these are written as plain
+loops for Numba to fuse.
+
+Products of probabilities down a tree of any size underflow float64, so
+each row of partial likelihoods is kept scaled: divided by its largest
+entry, with the log of that divisor added to the row's log scale along
+with its children's. That costs one log per node, rather than leaving
+and re-entering log space for every entry.
+"""
+import functools
+import math
+import numpy
+from numba import njit, prange
+
+# fastmath minus the flags that assume there are no infs or nans: a log scale
+# of -inf (data impossible under the model) is perfectly normal here
+FASTMATH = {"nsz", "arcp", "contract", "afn", "reassoc"}
+
+
+@njit(cache=True, fastmath=FASTMATH)
+def _rescale(x):
+    """Divide x by its max in place and return the log of the max"""
+    m = 0.0
+    for a in range(len(x)):
+        if x[a] > m:
+            m = x[a]
+    if m == 0.0:
+        return -numpy.inf
+    scale = 1.0 / m
+    for a in range(len(x)):
+        x[a] *= scale
+    return math.log(m)
+
+
+def _make_prune(K):
+    """Build the pruning kernel with the number of states fixed at K, so the
+    compiler can fully unroll the small matvecs, or read it from the buffers
+    at run time if K is 0"""
+    @njit(cache=True, fastmath=FASTMATH)
+    def _prune(P, left, right, order, L, log_scale, tip_states):
+        k = K if K > 0 else L.shape[1]
+        PL = numpy.empty((2, k), dtype=L.dtype)
+        n_known = len(tip_states)
+        for i in order:
+            l = left[i]
+            r = right[i]
+            sl = tip_states[l] if l < n_known else -1
+            sr = tip_states[r] if r < n_known else -1
+            # Each entry of P @ L is a dot product along a row of P, which
+            # runs along contiguous memory. A tip's one-hot vector just picks
+            # out column s of P, so children that are tips with known states
+            # are copied from it.
+            for a in range(k):
+                if sl >= 0:
+                    PL[0, a] = P[l, a, sl]
+                else:
+                    x = 0.0
+                    for b in range(k):
+                        x += P[l, a, b] * L[l, b]
+                    PL[0, a] = x
+                if sr >= 0:
+                    PL[1, a] = P[r, a, sr]
+                else:
+                    x = 0.0
+                    for b in range(k):
+                        x += P[r, a, b] * L[r, b]
+                    PL[1, a] = x
+            for a in range(k):
+                # Rounding in an eigendecomposed P can leave exact zeros a hair negative
+                L[i, a] = max(PL[0, a], 0.0) * max(PL[1, a], 0.0)
+            log_scale[i] = log_scale[l] + log_scale[r] + _rescale(L[i])
+        return L
+
+    @njit(cache=True, fastmath=FASTMATH)
+    def prune(P, left, right, order, L, log_scale, tip_states=None):
+        """Felsenstein's pruning algorithm over a flattened tree.
+        P: (n_nodes, k, k) transition matrices for the branch above each row.
+        left, right: child row indices.
+        order: internal rows to compute, each after its children.
+        L: (n_nodes, k) scaled partial likelihoods, filled in place.
+        log_scale: (n_nodes,) log of the factor each row of L has been divided by.
+        tip_states: optional state of each tip row, -1 for missing data. Tips
+        with a known state skip their matvec, as would every other entry of
+        their one-hot row in L.
+        """
+        if tip_states is None:
+            return _prune(P, left, right, order, L, log_scale, numpy.empty(0, numpy.int8))
+        return _prune(P, left, right, order, L, log_scale, tip_states)
+    return prune
+
+
+prune = _make_prune(0)
+
+@njit(cache=True, fastmath=FASTMATH)
+def _prune_sites_node(P, l, r, i, L, log_scale, PL, tip_states):
+    # Row i of prune_sites from its children l and r, with PL as scratch. As
+    # in prune(), tips with a known state at a site copy that column of P
+    k = L.shape[2]
+    n_known = tip_states.shape[0]
+    for s in range(L.shape[1]):
+        sl = tip_states[l, s] if l < n_known else -1
+        sr = tip_states[r, s] if r < n_known else -1
+        for a in range(k):
+            if sl >= 0:
+                PL[0, a] = P[l, a, sl]
+            else:
+                x = 0.0
+                for b in range(k):
+                    x += P[l, a, b] * L[l, s, b]
+                PL[0, a] = x
+            if sr >= 0:
+                PL[1, a] = P[r, a, sr]
+            else:
+                x = 0.0
+                for b in range(k):
+                    x += P[r, a, b] * L[r, s, b]
+                PL[1, a] = x
+        for a in range(k):
+            L[i, s, a] = max(PL[0, a], 0.0) * max(PL[1, a], 0.0)
+        log_scale[i, s] = log_scale[l, s] + log_scale[r, s] + _rescale(L[i, s])
+
+
+@njit(cache=True, fastmath=FASTMATH)
+def _prune_sites(P, left, right, order, L, log_scale, tip_states):
+    PL = numpy.empty((2, L.shape[2]), dtype=L.dtype)
+    for i in order:
+        _prune_sites_node(P, left[i], right[i], i, L, log_scale, PL, tip_states)
+    return L
+
+
+@njit(cache=True, fastmath=FASTMATH)
+def prune_sites(P, left, right, order, L, log_scale, tip_states=None):
+    """prune() for many sites at once, each row of L holding a partial
+    likelihood vector per site. Every branch's transition matrix is loaded
+    once and applied to all of the sites.
+    L: (n_nodes, n_sites, k) scaled partial likelihoods, filled in place.
+    log_scale: (n_nodes, n_sites) log scale factors.
+    tip_states: optional (n_tips, n_sites) states, -1 for missing data, which
+    lets tips with a known state skip their matvec as in prune().
+    """
+    if tip_states is None:
+        return _prune_sites(P, left, right, order, L, log_scale, numpy.empty((0, 0), numpy.int32))
+    return _prune_sites(P, left, right, order, L, log_scale, tip_states)
+
+
+@njit(cache=True, fastmath=FASTMATH, parallel=True)
+def _prune_sites_levels(P, left, right, rows, bounds, L, log_scale, tip_states):
+    for d in range(len(bounds) - 1):
+        for j in prange(bounds[d], bounds[d + 1]):
+            i = rows[j]
+            PL = numpy.empty((2, L.shape[2]), dtype=L.dtype)
+            _prune_sites_node(P, left[i], right[i], i, L, log_scale, PL, tip_states)
+    return L
+
+
+@njit(cache=True, fastmath=FASTMATH)
+def prune_sites_levels(P, left, right, rows, bounds, L, log_scale, tip_states=None):
+    """prune_sites() a level at a time, with the rows of each level, which
+    only depend on earlier levels, shared out across threads.
+    rows, bounds: the levels concatenated, level d being
+    rows[bounds[d]:bounds[d + 1]].
+    """
+    if tip_states is None:
+        return _prune_sites_levels(
+            P, left, right, rows, bounds, L, log_scale, numpy.empty((0, 0), numpy.int32)
+        )
+    return _prune_sites_levels(P, left, right, rows, bounds, L, log_scale, tip_states)
+
+
+# Coefficients of the (6, 6) Padé approximant to exp, and the largest 1-norm
+# it is used at. Its error there is ~1e-17, below double precision
+PADE6 = numpy.array([1.0, 1 / 2, 5 / 44, 1 / 66, 1 / 792, 1 / 15840, 1 / 665280])
+PADE6_NORM = 0.5
+
+
+@njit(cache=True, fastmath=FASTMATH, parallel=True)
+def expm_batch(A, out):
+    """Matrix exponential of each of a stack of small matrices, by scaling and
+    squaring with a Padé approximant. scipy.linalg.expm does the same job but
+    is built for large matrices, and on the (n, k, k) stack of a tree's
+    branches its setup outweighs the arithmetic.
+    A: (n, k, k) matrices. out: (n, k, k) buffer for their exponentials.
+    """
+    c = PADE6
+    k = A.shape[1]
+    I = numpy.eye(k)
+    for n in prange(A.shape[0]):
+        norm = 0.0
+        for j in range(k):
+            col = 0.0
+            for i in range(k):
+                col += abs(A[n, i, j])
+            norm = max(norm, col)
+        s = max(0, int(math.ceil(math.log2(norm / PADE6_NORM)))) if norm > 0.0 else 0
+        B = A[n] / 2.0 ** s
+        B2 = B @ B
+        B4 = B2 @ B2
+        B6 = B4 @ B2
+        U = B @ (c[1] * I + c[3] * B2 + c[5] * B4)
+        V = c[0] * I + c[2] * B2 + c[4] * B4 + c[6] * B6
+        X = numpy.ascontiguousarray(numpy.linalg.solve(V - U, V + U))
+        for _ in range(s):
+            X = X @ X
+        out[n] = X
+    return out
+
+
+@njit(cache=True, fastmath=FASTMATH)
+def mk_branch_matvec(k, Q, t, L, out):
+    """P(t) @ L for the equal rates Mk model without forming P(t).
+    Its spectrum is known: eigenvalue 0 for the all-ones vector and -kQ for
+    everything orthogonal to it, so with e = exp(-kQt)
+    P(t) @ L = sum(L)/k + e (L - sum(L)/k): one exp, one sum and one AXPY.
+    """
+    e = math.exp(-k * Q * t)
+    s = 0.0
+    for i in range(k):
+        s += L[i]
+    s *= (1.0 - e) / k
+    for i in range(k):
+        out[i] = s + e * L[i]
+    return out
+
+
+@njit(cache=True, fastmath=FASTMATH)
+def root_log_likelihood(L, log_scale):
+    """Log likelihood from the root's scaled partials, under a uniform prior on
+    the root state"""
+    s = 0.0
+    for a in range(len(L)):
+        s += L[a]
+    if s <= 0.0:
+        return -numpy.inf
+    return math.log(s / len(L)) + log_scale
+
+
+@njit(cache=True, fastmath=FASTMATH)
+def felsenstein_logl(P, left, right, order, root, L, log_scale):
+    """Prune the tree and return the log likelihood at the root"""
+    prune(P, left, right, order, L, log_scale)
+    return root_log_likelihood(L[root], log_scale[root])
+
+
+def _make_mk(K):
+    """Build the Mk kernels with the number of states fixed at K, as with
+    _make_prune, or taken from the k argument if K is 0"""
+    @njit(cache=True, fastmath=FASTMATH)
+    def mk_prune(k, Q, lengths, left, right, order, L, log_scale):
+        """prune() for the equal rates Mk model, straight from the branch
+        lengths with no transition matrices at all"""
+        k = K if K > 0 else k
+        PL = numpy.empty((2, k), dtype=L.dtype)
+        for i in order:
+            l = left[i]
+            r = right[i]
+            mk_branch_matvec(k, Q, lengths[l], L[l], PL[0])
+            mk_branch_matvec(k, Q, lengths[r], L[r], PL[1])
+            for a in range(k):
+                L[i, a] = PL[0, a] * PL[1, a]
+            log_scale[i] = log_scale[l] + log_scale[r] + _rescale(L[i])
+        return L
+
+    @njit(cache=True, fastmath=FASTMATH)
+    def mk_sample(k, weight, qcurrent, jitter, log_u, left, right, lengths, order, root, L, log_scale):
+        """The whole Metropolis loop of mcmc.sample for the Mk rate parameter.
+        jitter, log_u: one uniform(0, 1) draw and one log uniform(0, 1) draw per
+        sample, made by the caller so the random stream stays under its control.
+        L, log_scale: the flattened tree's partial likelihood buffers, used as
+        scratch.
+        """
+        samples = len(jitter)
+        posterior = numpy.empty(samples)
+        log_likelihood = numpy.empty(samples)
+        mk_prune(k, qcurrent, lengths, left, right, order, L, log_scale)
+        lcurrent = root_log_likelihood(L[root], log_scale[root])
+        for i in range(samples):
+            # Proposal density is uniform over [qcurrent - weight / 2, 2 * qcurrent]
+            qproposal = qcurrent - weight / 2 + (qcurrent + weight / 2) * jitter[i]
+            # The log prior ratio under the uniform(0, 1) prior is 0 inside it and
+            # -inf outside, where the proposal can never be accepted, so there's
+            # no need to compute the likelihood at all
+            if 0.0 <= qproposal <= 1.0:
+                mk_prune(k, qproposal, lengths, left, right, order, L, log_scale)
+                lproposal = root_log_likelihood(L[root], log_scale[root])
+                # Acceptance ratio, basically Bayes' theorem in log space
+                if log_u[i] < lproposal - lcurrent:
+                    qcurrent = qproposal
+                    lcurrent = lproposal
+            posterior[i] = qcurrent
+            log_likelihood[i] = lcurrent
+        return posterior, log_likelihood
+
+    return mk_prune, mk_sample
+
+
+mk_prune, mk_sample = _make_mk(0)
+
+@njit(cache=True, fastmath=FASTMATH, parallel=True)
+def mk_log_likelihoods(k, rates, lengths, left, right, order, root, L, log_scale):
+    """Log likelihood of one tree under the Mk model at each of many rates,
+    the rates shared out across threads. Each works on its own copy of the
+    partials, so L and log_scale only supply the tips and are left alone.
+    """
+    out = numpy.empty(len(rates))
+    for b in prange(len(rates)):
+        Lb = L.copy()
+        log_scale_b = log_scale.copy()
+        mk_prune(k, rates[b], lengths, left, right, order, Lb, log_scale_b)
+        out[b] = root_log_likelihood(Lb[root], log_scale_b[root])
+    return out
+
+
+# Up to this many states the unrolled kernels are 2-3x faster; past about 8
+# the unrolled code gets slower than the loops
+SPECIALISED_STATES = 4
+
+
+@functools.lru_cache(maxsize=None)
+def prune_for(k):
+    """The pruning kernel to use for k states"""
+    return _make_prune(k) if k <= SPECIALISED_STATES else prune
+
+
+@functools.lru_cache(maxsize=None)
+def mk_kernels_for(k):
+    """(mk_prune, mk_sample) to use for k states"""
+    return _make_mk(k) if k <= SPECIALISED_STATES else (mk_prune, mk_sample)
@@ -1,10 +1,10 @@
 """
 Markov Chain Monte Carlo sampling control logic.
 """
-import copy
-import random
-import scipy.stats as stats
+import numpy
 from fulgurite.tree import PhyloTree
+from fulgurite.mkmodel import MkModel
+from fulgurite._kernels import mk_kernels_for
 
 
 def sample(tree: PhyloTree, samples, weight=0.2):
@@ -12,61 +12,53 @@ def sample(tree: PhyloTree, samples, weight=0.2):
     Estimate Mk model rate parameter Q by constructing an ergodic, reversible
     Markov chain, the stationary distribution of which is the same as the
     posterior that we're trying to estimate. It's kind of like magic tbh.
+    The loop itself is compiled, see _kernels.mk_sample; only the random
+    numbers are drawn here.
     """
-    posterior = []
-    likelihood = []
-    qcurrent = stats.uniform(0, 1).rvs()
-    for i in range(samples):
-        # Select proposed value of q based on proposal weight density
-        qproposal = stats.uniform(qcurrent - weight / 2, qcurrent + weight / 2).rvs()
-
-        # Calculate prior odds ratio: the ratio of the prior probability of the
-        # proposal divided by the prior probability of the current value. And
-        # to get the prior probability of each value we just need to call the
-        # probability density function of the prior distribution with that value.
-        prior_ratio = stats.uniform.pdf(qproposal) / stats.uniform.pdf(qcurrent)
-        
-        # Calculate likelihoods
-        lcurrent = tree.root.get_likelihood(qcurrent)
-        lproposal = tree.root.get_likelihood(qproposal)
-        likely_ratio = lproposal / lcurrent
-
-        # Calculate acceptance ratio  and decide whether to accept proposal.
-        # Notice how this is basically Bayes' theorem
-        accept_ratio = likely_ratio * prior_ratio
-        if stats.uniform(0, 1).rvs() < accept_ratio:
-            qcurrent = qproposal
-
-        # Add this sample to the set of posterior samples
-        posterior.append(qcurrent)
-        likelihood.append(lcurrent)
-
-    return posterior, likelihood
+    # Draw all the random numbers up front rather than one call each
+    rng = numpy.random.default_rng()
+    qcurrent = rng.random()
+    jitter = rng.random(samples)
+    with numpy.errstate(divide="ignore"):
+        log_u = numpy.log(rng.random(samples))
+    flat = tree.flatten()
+    _, mk_sample = mk_kernels_for(tree.n_states)
+    posterior, log_likelihood = mk_sample(
+        tree.n_states, weight, qcurrent, jitter, log_u,
+        flat.left, flat.right, flat.lengths, flat.order, flat.root,
+        flat.likelihoods, flat.log_scales,
+    )
+    # The buffers were used as scratch
+    flat.invalidate()
+    return posterior.tolist(), log_likelihood.tolist()
 
 
 # ...Attempt with fixed Q and varying tree topology
 def sample_topology(tree: PhyloTree, samples):
+    """Metropolis sampling of tree topology with subtree prune and regraft
+    moves. Moves are made on the tree in place and undone if rejected, so
+    the posterior is recorded as Newick strings. The tree is left in the
+    state of the last sample."""
     posterior = []
-    likelihood = []
-    current = tree
+    log_likelihood = []
+    # Q is fixed, so the model is built once and reused for the whole chain
+    model = MkModel(0.5, tree.n_states)
+    with numpy.errstate(divide="ignore"):
+        log_u = numpy.log(numpy.random.default_rng().random(samples))
+    lcurrent = tree.get_log_likelihood(model)
     for i in range(samples):
-        lcurrent = current.root.get_likelihood(0.5)
-        
         # Modify the tree topology by randomly pruning and regrafting a subtree
-        workingcopy = copy.deepcopy(tree)
-        subtree, loc = workingcopy.random_node(2)
-        workingcopy.regraft(subtree, loc)
-        lproposal = workingcopy.root.get_likelihood(0.5)
+        move = tree.propose_spr()
+        lproposal = tree.get_log_likelihood(model)
 
         # Right now I've got no tree prior, so will just consider the prior
         # odds ratio as 1
-        likely_ratio = lproposal / lcurrent
-        accept_ratio = likely_ratio
-        if stats.uniform(0, 1).rvs() < accept_ratio:
-            current = workingcopy
-            likelihood.append(lproposal)
+        log_accept_ratio = lproposal - lcurrent
+        if log_u[i] < log_accept_ratio:
+            lcurrent = lproposal
         else:
-            likelihood.append(lcurrent)
-        posterior.append(current)
+            tree.revert(move)
+        log_likelihood.append(lcurrent)
+        posterior.append(tree.to_string())
         
-    return posterior, likelihood # Treat this as the posterior val of tree since no prior
+    return posterior, log_likelihood # Treat this as the posterior val of tree since no prior
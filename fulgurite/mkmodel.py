@@ -5,9 +5,11 @@ that any pairwise transition between states has probability Q.  For
 any Q matrix, the sum of all the elements in a row should be 0 as this
 is a necessary condition for a transition rate matrix.
 """
+import functools
 import numpy
-import scipy
-from anytree.iterators.levelorderiter import LevelOrderIter
+from fulgurite._kernels import (
+    expm_batch, mk_kernels_for, mk_log_likelihoods, prune_for, prune_sites_levels, root_log_likelihood,
+)
 
 
 def make_transition_matrix(Q, k):
@@ -15,36 +17,274 @@ def make_transition_matrix(Q, k):
     Q: rate parameter. The state transition probability.
     k: number of discrete states.
     """
-    d = -(k - 1) * Q
-    rows = []
-    for i in range(k):
-        row = [Q for i in range(k)]
-        row[i] = d
-        rows.append(row)
-    return numpy.array(rows)
+    matrix = numpy.full((k, k), float(Q))
+    numpy.fill_diagonal(matrix, -(k - 1) * Q)
+    return matrix
 
 
-def node_state_likelihoods(node, matrix):
-    P = scipy.linalg.expm(node.length * matrix)
-    result = []
-    for state in range(len(node.likelihoods)):
-        state_L = sum([x * P[i][state] for i, x in enumerate(node.likelihoods)])
-        result.append(state_L)
-    return result
+# Past this condition number for the eigenvectors P(t) = V diag(exp(λt)) V⁻¹
+# has lost most of its digits to the inverse
+DEFECTIVE_CONDITION = 1e8
 
 
-def combine_likelihoods(node, matrix):
+class RateModel:
+    """Transition rate matrix together with its eigendecomposition.
+    Q only changes when the MCMC proposes a new rate, so we decompose it once
+    as Q = V diag(λ) V⁻¹ and every branch exponential becomes
+    P(t) = V diag(exp(λt)) V⁻¹, an elementwise exp and a matrix product,
+    instead of a full scipy.linalg.expm per branch.
+    Q: transition rate matrix. Symmetric ones, like Mk, are decomposed with
+    eigh; anything else falls back to eig and an explicit inverse, with
+    complex eigenvalues allowed for rate matrices that aren't reversible.
+    A Q that can't be diagonalised at all leaves eig with near parallel
+    eigenvectors and a meaningless inverse, so for those every P(t) comes
+    from a compiled matrix exponential instead, _kernels.expm_batch, all of
+    a tree's branches in one call.
+    """
+    def __init__(self, Q):
+        self.Q = Q
+        if numpy.allclose(Q, Q.T):
+            self.eigvals, self.eigvecs = numpy.linalg.eigh(Q)
+            # eigh gives orthonormal eigenvectors, so the inverse is the transpose
+            self.eigvecs_inv = self.eigvecs.T
+        else:
+            self.eigvals, self.eigvecs = numpy.linalg.eig(Q)
+            self.eigvecs_inv = numpy.linalg.inv(self.eigvecs)
+        self.defective = numpy.linalg.cond(self.eigvecs) > DEFECTIVE_CONDITION
+        self._P_cache = {}
+
+    @property
+    def k(self):
+        return len(self.eigvals)
+
+    def P(self, t):
+        """Transition probability matrix for a branch of length t. Memoised,
+        since a model lives for one value of Q and trees repeat lengths."""
+        P = self._P_cache.get(t)
+        if P is None:
+            if self.defective:
+                P = expm_batch(self.Q[None] * t, numpy.empty((1, self.k, self.k)))[0]
+            else:
+                P = ((self.eigvecs * numpy.exp(self.eigvals * t)) @ self.eigvecs_inv).real
+            P.flags.writeable = False
+            self._P_cache[t] = P
+        return P
+
+    def P_all(self, lengths, out=None):
+        """Transition matrices for a whole array of branch lengths at once.
+        One broadcast exp and einsum instead of a Python call per branch.
+        out: optional (len(lengths), k, k) buffer to write them into.
+        """
+        if self.defective:
+            A = numpy.multiply.outer(lengths, self.Q)
+            P = expm_batch(A, numpy.empty_like(A))
+            if out is None:
+                return P
+            out[...] = P
+            return out
+        exps = numpy.exp(numpy.outer(lengths, self.eigvals))
+        if numpy.iscomplexobj(exps):
+            # The imaginary parts cancel, but not in a real buffer
+            P = numpy.einsum(
+                "ij,bj,jk->bik", self.eigvecs, exps, self.eigvecs_inv, optimize=True
+            ).real
+            if out is None:
+                return P
+            out[...] = P
+            return out
+        return numpy.einsum(
+            "ij,bj,jk->bik", self.eigvecs, exps, self.eigvecs_inv,
+            out=out, casting="same_kind", optimize=True,
+        )
+
+    def prune(self, flat, order, changed=None):
+        """Recompute the partial likelihoods of flat's rows in order.
+        changed: rows whose branch lengths changed since the last call, or
+        None to refill every transition matrix.
+        """
+        if changed is None:
+            self.P_all(flat.lengths, out=flat.transitions)
+        else:
+            flat.transitions[changed] = self.P_all(flat.lengths[changed])
+        prune_for(self.k)(
+            flat.transitions, flat.left, flat.right, order, flat.likelihoods,
+            flat.log_scales, flat.tip_states,
+        )
+
+
+class MkModel(RateModel):
+    """The equal rates Mk model, for which P(t) has a closed form.
+    With e = exp(-kQt), P(t)_ii = 1/k + (k-1)/k e and P(t)_ij = 1/k - e/k,
+    so no matrix exponential or matrix product is needed at all.
+    The spectrum is known too, 0 once and -kQ k - 1 times, so Q is never
+    decomposed and pruning applies P(t) to each vector directly.
+    Q: rate parameter.
+    k: number of discrete states.
+    """
+    def __init__(self, Q, k):
+        self.Q = make_transition_matrix(Q, k)
+        self.rate = Q
+        self.eigvals = numpy.full(k, -k * Q)
+        self.eigvals[0] = 0.0
+
+    def P(self, t):
+        e = numpy.exp(-self.k * self.rate * t)
+        P = numpy.full((self.k, self.k), (1 - e) / self.k)
+        numpy.fill_diagonal(P, (1 + (self.k - 1) * e) / self.k)
+        return P
+
+    def P_all(self, lengths, out=None):
+        e = numpy.exp(-self.k * self.rate * numpy.asarray(lengths))[:, None, None]
+        out = numpy.multiply(e, numpy.eye(self.k), out=out)
+        out += (1 - e) / self.k
+        return out
+
+    def prune(self, flat, order, changed=None):
+        mk_prune, _ = mk_kernels_for(self.k)
+        mk_prune(
+            self.k, self.rate, flat.lengths, flat.left, flat.right, order,
+            flat.likelihoods, flat.log_scales,
+        )
+
+
+@functools.lru_cache(maxsize=128)
+def mk_model(Q, k):
+    """The MkModel for rate Q and k states, shared between calls with the same
+    arguments. A flattened tree only keeps its partials for the model object
+    it was last evaluated with, so handing out one object per rate is what
+    lets repeated evaluations at a fixed Q take the incremental path.
+    """
+    return MkModel(Q, k)
+
+
+@functools.lru_cache(maxsize=128)
+def _rate_model(data, shape):
+    """The RateModel for the rate matrix with bytes data and this shape, shared
+    the same way as mk_model. Keyed on the bytes since arrays aren't hashable.
+    """
+    return RateModel(numpy.frombuffer(data).reshape(shape).copy())
+
+
+def as_model(Q, k):
+    """The model to evaluate trees under for Q, which can be a model already,
+    an Mk rate parameter for k states, or a full rate matrix. Equal rates
+    matrices get the closed form MkModel rather than an eigendecomposition.
+    Models built here are cached on Q, so passing the same rates again gets
+    the same object back.
+    """
+    if isinstance(Q, RateModel):
+        return Q
+    if numpy.ndim(Q) == 0:
+        return mk_model(Q, k)
+    Q = numpy.asarray(Q, dtype=float)
+    off_diagonal = Q[~numpy.eye(len(Q), dtype=bool)]
+    if len(Q) > 1 and (off_diagonal == off_diagonal[0]).all() and numpy.allclose(Q.sum(axis=1), 0):
+        return mk_model(float(off_diagonal[0]), len(Q))
+    return _rate_model(Q.tobytes(), Q.shape)
+
+
+def combine_likelihoods(node, model):
+    """Partial likelihoods of node from its children's, as one batched matmul
+    pushing both children's vectors through their transition matrices and
+    a Hadamard product of the results. The NumPy reference for the kernels.
+    """
     if node.children:
-        lls, lrs = [node_state_likelihoods(c, matrix) for c in node.children]
-        return [r * l for r, l in zip(lls, lrs)]
+        left, right = node.children
+        P = model.P_all(numpy.array([left.length, right.length]))
+        x = numpy.stack([left.likelihoods, right.likelihoods])
+        PL, PR = numpy.matmul(P, x[:, :, None])[:, :, 0]
+        return PL * PR
     return node.likelihoods
 
 
-def subtree_likelihood(node, Q):
-    # TODO Implement reverse level order traversal properly, as it's currently
-    # at least O(n²) depending on how efficient reversed() is
-    matrix = make_transition_matrix(Q, len(node.likelihoods))
-    for n in node.reverse_level_walk():
-        n.likelihoods = combine_likelihoods(n, matrix)
-    prior = 1 / len(node.likelihoods) # Uniform prior
-    return sum([prior * l for l in node.likelihoods])
+def prune_levels(P, left, right, levels, L, log_scale):
+    """Level synchronous version of _kernels.prune. Each level's child vectors
+    are stacked and pushed through their transition matrices in one batched
+    matmul per side, so the work goes to BLAS in a handful of large calls.
+    The compiled kernel is faster at every k we've measured, so this stays as
+    the NumPy reference for it.
+    levels: lists of rows whose children are all in earlier levels.
+    """
+    for rows in levels:
+        lc, rc = left[rows], right[rows]
+        PL = numpy.matmul(P[lc], L[lc][:, :, None])[:, :, 0]
+        PR = numpy.matmul(P[rc], L[rc][:, :, None])[:, :, 0]
+        partial = numpy.maximum(PL, 0.0) * numpy.maximum(PR, 0.0)
+        m = partial.max(axis=1)
+        with numpy.errstate(divide="ignore", invalid="ignore"):
+            L[rows] = numpy.where(m[:, None] > 0, partial / m[:, None], 0.0)
+            log_scale[rows] = log_scale[lc] + log_scale[rc] + numpy.log(m)
+    return L
+
+
+def tree_log_likelihood(flat, model):
+    """Felsenstein's pruning algorithm over a flattened tree, with the partials
+    rescaled at every node and the log scale factors carried along.
+    flat: a tree.FlatTree. Partial likelihoods are written into its buffers
+    and kept there, so if model is the one used last time only the rows the
+    tree has marked as changed need recomputing.
+    """
+    if flat.model is not model:
+        flat.save()
+        model.prune(flat, flat.order)
+    elif flat.pending:
+        # Same model as last time and a local change: only redo the branches
+        # whose lengths changed and the paths from them to the root
+        rows = numpy.array(flat.pending, dtype=numpy.int32)
+        changed = numpy.array(flat.changed_lengths, dtype=numpy.int32)
+        flat.save(numpy.concatenate([rows, changed]))
+        model.prune(flat, rows, changed)
+    flat.clean(model)
+    return root_log_likelihood(flat.likelihoods[flat.root], flat.log_scales[flat.root])
+
+
+def rate_log_likelihoods(flat, rates, k):
+    """Log likelihoods of a flattened tree under the Mk model at every rate in
+    rates, evaluated in parallel, e.g. for a grid over Q or a batch of MCMC
+    proposals. flat's own buffers are left as they were.
+    """
+    return mk_log_likelihoods(
+        k, numpy.asarray(rates, dtype=float), flat.lengths, flat.left, flat.right,
+        flat.order, flat.root, flat.likelihoods, flat.log_scales,
+    )
+
+
+def site_patterns(flat, site_states):
+    """The distinct columns of tip states and how many sites share each.
+    site_states: {label: sequence of states}, one state per site. Tips that
+    aren't in it get -1 at every site, meaning no data.
+    Returns an (n_tips, n_patterns) array of states and the pattern counts.
+    """
+    n_sites = len(next(iter(site_states.values())))
+    missing = numpy.full(n_sites, -1)
+    columns = numpy.array([
+        site_states.get(n.label, missing) for n in flat.nodes[:flat.n_tips]
+    ], dtype=numpy.int32).reshape(flat.n_tips, n_sites)
+    return numpy.unique(columns, axis=1, return_counts=True)
+
+
+def sites_log_likelihood(flat, model, site_states):
+    """Total log likelihood of many characters on one tree, pruning all the
+    distinct site patterns together, one level of the tree at a time in
+    parallel.
+    flat: a tree.FlatTree, which supplies the topology and branch lengths.
+    Its own single site buffers are left alone.
+    site_states: {label: sequence of states}, see site_patterns.
+    """
+    patterns, weights = site_patterns(flat, site_states)
+    k = model.k
+    L = numpy.zeros((len(flat.nodes), patterns.shape[1], k), dtype=flat.likelihoods.dtype)
+    L[:flat.n_tips] = numpy.vstack([numpy.eye(k), numpy.ones(k)])[patterns]
+    log_scale = numpy.zeros(L.shape[:2])
+    P = model.P_all(flat.lengths).astype(L.dtype, copy=False)
+    # Each level is plenty of work with all the sites, so it is split across
+    # threads; one site's worth per node would be too little to be worth it
+    levels = flat.levels
+    # A tree of a single tip has no internal rows, so no levels to join
+    rows = numpy.concatenate(levels) if levels else numpy.zeros(0, dtype=numpy.int32)
+    bounds = numpy.cumsum([0] + [len(level) for level in levels])
+    prune_sites_levels(P, flat.left, flat.right, rows, bounds, L, log_scale, patterns)
+    root = flat.root
+    with numpy.errstate(divide="ignore"):
+        site_logL = numpy.log(L[root].sum(axis=1) / k) + log_scale[root]
+    return weights @ site_logL
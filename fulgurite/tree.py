@@ -1,22 +1,302 @@
+import copy
+import math
 import newick
+import numpy
 import anytree
 import random
 import collections
 import fulgurite.mkmodel as mkmodel
 
+# Everything PhyloTree.revert() needs to undo a prune_and_regraft: the moved
+# subtree and which child of its parent it was, the sibling and grandparent it
+# was cut from, where it went, and the three branch lengths the move changed
+Undo = collections.namedtuple("Undo", [
+    "subtree", "index", "sibling", "grandparent",
+    "parent_length", "sibling_length", "loc", "loc_length",
+])
+
+# PhyloTree.revert()'s record of a nearest neighbour interchange: node, and the
+# child of it that traded places with node's sibling
+Swap = collections.namedtuple("Swap", ["node", "child", "sibling"])
+
+
+def _reverselevelorder(start):
+    # The list doubles as the BFS queue: everything before i has been visited
+    result = [start]
+    i = 0
+    while i < len(result):
+        result.extend(result[i].children)
+        i += 1
+    result.reverse()
+    return result
+
 
 def reverselevelorder(node):
     """Walk the tree in reverse level order, in O(n) time"""
-    leaves = sorted(node.leaves, key=lambda n: n.height)
-    queue = collections.deque([node.root])
-    result = collections.deque()
-    while queue:
-        this = queue.popleft()
-        result.appendleft(this)
-        queue.extend(this.children)
+    return _reverselevelorder(node.root)
+
+
+def postorder(node):
+    """Walk the tree in post-order, children always before their parent, in O(n) time"""
+    stack = [node]
+    result = []
+    while stack:
+        this = stack.pop()
+        result.append(this)
+        stack.extend(this.children)
+    result.reverse()
     return result
 
 
+class FlatTree:
+    """Struct-of-arrays layout of a PhyloNode tree for the likelihood numerics.
+    Rows initially hold the leaves first and then the internal nodes in
+    post-order, so every node comes after its children and the root is the
+    last row. The PhyloNodes stay the thing to manipulate: update() re-reads
+    all of them, refilling the same arrays, while rewire() re-reads just the
+    few a local move touched. Rows stay put under rewire(), so partial
+    likelihoods away from the move remain valid and only the paths from the
+    move to the root are marked for recomputation.
+    states: optional {label: state} dict to take the tip data from, instead of
+    the likelihood arrays stored on the leaves.
+    dtype: float type of the partials and transition matrices. float32 halves
+    the memory traffic of the pruning on big trees; the log scale factors
+    stay float64 as they accumulate over the whole tree.
+    """
+    def __init__(self, root, k, states=None, dtype=numpy.float64):
+        order = postorder(root)
+        size = len(order)
+        self.parent = numpy.full(size, -1, dtype=numpy.int32)
+        self.left = numpy.full(size, -1, dtype=numpy.int32)
+        self.right = numpy.full(size, -1, dtype=numpy.int32)
+        self.lengths = numpy.zeros(size)
+        # Partial likelihoods, each row scaled so its largest entry is 1, and
+        # the log of the factor it was divided by
+        self.likelihoods = numpy.zeros((size, k), dtype=dtype)
+        self.log_scales = numpy.zeros(size)
+        # Transition matrix for the branch above each row, filled by the model
+        self.transitions = numpy.zeros((size, k, k), dtype=dtype)
+        self.dirty = numpy.zeros(size, dtype=numpy.bool_)
+        self.states = states
+        self.update(root, order)
+
+    def update(self, root, order=None):
+        """Refill the arrays from the tree below root, which must have the same
+        number of nodes as when this was built.
+        order: postorder(root), if the caller already has it.
+        """
+        if order is None:
+            order = postorder(root)
+        leaves = [n for n in order if not n.children]
+        self.nodes = leaves + [n for n in order if n.children]
+        self.n_tips = len(leaves)
+        self.rows = {id(n): i for i, n in enumerate(self.nodes)}
+        k = self.likelihoods.shape[1]
+        self._relink(self.nodes, root)
+        # Tip data never changes, so the whole (n_tips, k) block is built in
+        # one gather over the leaves in row order, and the pruning never
+        # writes to these rows again. Leaves with no data get a row of 1s,
+        # i.e. any state is possible.
+        if self.states is not None:
+            # Each tip's state, or -1 for no data, which picks the row of 1s.
+            # A byte per tip is enough for any character we'd model
+            self.tip_states = numpy.fromiter(
+                (self.states.get(n.label, -1) for n in leaves),
+                dtype=numpy.int8 if k <= 127 else numpy.int32, count=self.n_tips,
+            )
+            self.tip_likelihoods = numpy.vstack([numpy.eye(k), numpy.ones(k)])[self.tip_states]
+        else:
+            self.tip_states = None
+            self.tip_likelihoods = numpy.array([
+                n.likelihoods if len(n.likelihoods) == k else numpy.ones(k)
+                for n in leaves
+            ], dtype=float).reshape(self.n_tips, k)
+        self.likelihoods[:self.n_tips] = self.tip_likelihoods
+        self.likelihoods[self.n_tips:] = 0.0
+        self.log_scales[:] = 0.0
+        self._order = numpy.arange(self.n_tips, len(self.nodes), dtype=numpy.int32)
+        self._levels = None
+        # Model the partials were last computed with; None forces a full pass
+        self.model = None
+        self.pending = []
+        self.changed_lengths = []
+        self._undo = None
+        self.dirty[:] = False
+        return self
+
+    def _relink(self, nodes, root):
+        """Re-read nodes into their rows, returning the rows whose branch length
+        changed"""
+        rows = self.rows
+        changed = []
+        for node in nodes:
+            i = rows[id(node)]
+            self.parent[i] = -1 if node is root else rows[id(node.parent)]
+            length = node.length if node.length else 0.0
+            if length != self.lengths[i]:
+                self.lengths[i] = length
+                changed.append(i)
+            if node.children:
+                left, right = node.children
+                self.left[i], self.right[i] = rows[id(left)], rows[id(right)]
+            else:
+                self.left[i] = self.right[i] = -1
+        self.root = rows[id(root)]
+        return changed
+
+    def rewire(self, nodes, root, dirty):
+        """Re-read nodes after a local topology change and mark the paths from
+        each of dirty to the root for recomputation. Starts an undo log so that
+        rollback() can restore the partials if the move is reverted."""
+        if self.pending:
+            # Marks from an earlier topology can't be ordered against new ones
+            self.model = None
+        self._undo = (
+            self._order, list(self.pending), list(self.changed_lengths), [],
+            {id(n) for n in nodes},
+        )
+        self.changed_lengths.extend(self._relink(nodes, root))
+        self._order = self._levels = None
+        for node in dirty:
+            self._mark(self.rows[id(node)])
+
+    def rollback(self, nodes, root):
+        """Undo the last rewire(), restoring the saved partial likelihoods.
+        Only the most recent move has its partials saved, so undoing any
+        older one just re-reads the nodes and leaves a full pass to be done.
+        """
+        self._relink(nodes, root)
+        self._levels = None
+        if self._undo is None or self._undo[4] != {id(n) for n in nodes}:
+            self._order = None
+            self.model = None
+            self.pending = []
+            self.changed_lengths = []
+            self.dirty[:] = False
+            self._undo = None
+            return
+        self._order, self.pending, self.changed_lengths, saved, _ = self._undo
+        if saved is None:
+            # Everything was recomputed since the move, so nothing to restore
+            self.model = None
+        for rows, likelihoods, log_scales, transitions in reversed(saved or []):
+            self.likelihoods[rows] = likelihoods
+            self.log_scales[rows] = log_scales
+            self.transitions[rows] = transitions
+        self.dirty[:] = False
+        self.dirty[self.pending] = True
+        self._undo = None
+
+    def _mark(self, i):
+        # Mark the path up from row i until it joins one already marked. The
+        # new rows only depend on clean ones, so they go ahead of the rest.
+        path = []
+        while i >= 0 and not self.dirty[i]:
+            self.dirty[i] = True
+            path.append(i)
+            i = self.parent[i]
+        self.pending[:0] = path
+
+    def save(self, rows=None):
+        """Record rows of the buffers about to be overwritten, for rollback().
+        rows: None if the whole buffer is about to be overwritten."""
+        if self._undo is None:
+            return
+        if rows is None:
+            self._undo = self._undo[:3] + (None,) + self._undo[4:]
+        elif self._undo[3] is not None:
+            self._undo[3].append(
+                (rows, self.likelihoods[rows], self.log_scales[rows], self.transitions[rows])
+            )
+
+    def invalidate(self):
+        """Forget the partials, after something else has used the buffers"""
+        self.model = None
+        self.save()
+
+    def clean(self, model):
+        """Mark everything as computed under model"""
+        self.model = model
+        self.dirty[self.pending] = False
+        self.pending = []
+        self.changed_lengths = []
+
+    def copy(self):
+        """Independent snapshot of the arrays. The PhyloNodes are shared, so the
+        copy can still be labelled, but it doesn't follow later moves."""
+        clone = copy.copy(self)
+        for name in ("parent", "left", "right", "lengths", "likelihoods",
+                     "log_scales", "transitions", "dirty"):
+            setattr(clone, name, getattr(self, name).copy())
+        clone.pending = list(self.pending)
+        clone.changed_lengths = list(self.changed_lengths)
+        clone._undo = None
+        return clone
+
+    @property
+    def order(self):
+        """Internal rows in an order where children come before parents"""
+        if self._order is None:
+            order = []
+            stack = [self.root]
+            while stack:
+                i = stack.pop()
+                if self.left[i] >= 0:
+                    order.append(i)
+                    stack.extend((self.left[i], self.right[i]))
+            self._order = numpy.array(order[::-1], dtype=numpy.int32)
+        return self._order
+
+    @property
+    def levels(self):
+        """Internal rows grouped by height above the tips. The children of every
+        row in a level are all in earlier levels, so a level can be computed
+        as one batch."""
+        if self._levels is None:
+            # Sweep up from the tips counting finished children, so each row
+            # joins a level exactly once, as soon as its second child is done
+            ready = numpy.zeros(len(self.nodes), dtype=numpy.int8)
+            done = numpy.arange(self.n_tips, dtype=numpy.int32)
+            levels = []
+            while True:
+                parents = self.parent[done]
+                parents = parents[parents >= 0]
+                numpy.add.at(ready, parents, 1)
+                done = numpy.unique(parents[ready[parents] == 2])
+                if not len(done):
+                    break
+                levels.append(done)
+            self._levels = levels
+        return self._levels
+
+
+def _set_children(node, children):
+    """node.children = children, without anytree's checks.
+    anytree's setter walks every new child's ancestors looking for a loop,
+    and an SPR move sets children half a dozen times, so the walks up a deep
+    tree cost more than the rest of the move. The moves check their own
+    validity with can_regraft first, so they relink the nodes directly.
+    """
+    for child in node.children:
+        child._NodeMixin__parent = None
+    for child in children:
+        old = child.parent
+        if old is not None and old is not node:
+            old._NodeMixin__children = [c for c in old.children if c is not child]
+        child._NodeMixin__parent = node
+    node._NodeMixin__children = list(children)
+
+
+def _replace_child(parent, old, new):
+    """Put new in old's place among parent's children, keeping their order"""
+    children = list(parent.children)
+    for i, child in enumerate(children):
+        if child is old:
+            children[i] = new
+            break
+    _set_children(parent, children)
+
+
 class PhyloNodeError(Exception):
     pass
 
@@ -26,41 +306,288 @@ class PhyloTree:
     This allows manipulation of the tree without needing to keep track of the root node
     externally when attaching and detaching nodes. Also allows storing info which is
     relevant for the whole tree such as a list of nodes so selection can be O(1), the
-    list of states, etc."""
-    def __init__(self, root, states=dict(), nodes=None):
+    list of states, etc.
+    dtype: float type for the likelihood calculations, see FlatTree.
+    """
+    def __init__(self, root, states=dict(), nodes=None, dtype=numpy.float64):
         self.root = root
         self.states = states
+        self.dtype = dtype
         if not nodes:
             self.nodes = [n for n in anytree.PreOrderIter(self.root)]
         else:
             self.nodes = nodes
+            self._root_first()
+        self._flat = None
+        self._is_binary = None
+        self._node_ids = None
+        self._leaves_by_label = None
 
     @classmethod
-    def from_string(cls, newickstr, states):
+    def from_string(cls, newickstr, states, dtype=numpy.float64):
         root = PhyloNode.from_string(newickstr, states=states)
-        return PhyloTree(root, states)
+        return PhyloTree(root, states, dtype=dtype)
 
     def attach(self, subtree, loc):
-        if loc not in self.nodes:
+        if id(loc) not in self.node_ids:
             raise PhyloNodeError("Node not in tree!")
         loc.attach(subtree) # Yuck, fix
+        # Keep the node list current rather than walking the whole tree again:
+        # the new nodes are the subtree and the node attach() put above loc's
+        # old children
+        added = [loc.children[0]] + postorder(subtree)
+        self.nodes.extend(added)
+        node_ids, is_binary = self._node_ids, self._is_binary
+        self._structure_changed()
+        if node_ids is not None:
+            node_ids.update(id(n) for n in added)
+            self._node_ids = node_ids
+        # attach() splits loc's branch, so the rest of the tree keeps its shape
+        if is_binary is not None:
+            self._is_binary = is_binary and subtree.is_binary
         return self
 
     def detach(self, subtree):
-        if subtree not in self.nodes:
+        if id(subtree) not in self.node_ids:
             raise PhyloNodeError("Node not in tree!")
-        self.root = subtree.detach()
+        parent = subtree.parent
+        new_root = subtree.detach()
+        # The subtree leaves along with its parent, which detach() collapses
+        gone = {id(n) for n in postorder(subtree)} | {id(parent)}
+        self.nodes = [n for n in self.nodes if id(n) not in gone]
+        if parent is self.root:
+            self.root = new_root
+            self._root_first()
+        node_ids, is_binary = self._node_ids, self._is_binary
+        self._structure_changed()
+        if node_ids is not None:
+            self._node_ids = node_ids - gone
+        # detach() collapses the branch it leaves behind, keeping the rest binary
+        self._is_binary = True if is_binary else None
         return self
 
+    def _structure_changed(self):
+        # attach and detach restore the node id set and is_binary themselves,
+        # where they can do so without walking the whole tree
+        self._flat = None
+        self._is_binary = None
+        self._node_ids = None
+        self._leaves_by_label = None
+
+    def _root_first(self):
+        # The root is kept at the front of the node list, so the rest of the
+        # list is exactly the nodes random_node() can choose from
+        nodes = self.nodes
+        for i, node in enumerate(nodes):
+            if node is self.root:
+                nodes[0], nodes[i] = nodes[i], nodes[0]
+                return
+
+    def _set_root(self, root):
+        # An SPR move next to the root swaps which node is the root
+        self.root = root
+        self._root_first()
+
+    @property
+    def node_ids(self):
+        """Set of the ids of every node, for O(1) membership tests"""
+        if self._node_ids is None:
+            self._node_ids = {id(n) for n in self.nodes}
+        return self._node_ids
+
     def regraft(self, subtree, loc):
         self.detach(subtree)
         self.attach(subtree, loc)
         return self
 
+    def random_node(self):
+        """Select a random non-root node, in O(1) from the node list"""
+        return self.nodes[random.randrange(1, len(self.nodes))]
+
+    @property
+    def is_binary(self):
+        """Cached PhyloNode.is_binary of the root. SPR moves keep a tree binary,
+        and attach and detach update it from the subtree they move."""
+        if self._is_binary is None:
+            self._is_binary = self.root.is_binary
+        return self._is_binary
+
+    def can_regraft(self, subtree, loc):
+        """True if moving subtree onto the branch above loc is a valid SPR move
+        which changes the topology"""
+        if subtree is self.root or loc is self.root:
+            return False
+        if loc is subtree.parent or loc is subtree.sibling:
+            return False
+        # Walk up from loc by hand rather than building loc.path
+        node = loc
+        while node is not None:
+            if node is subtree:
+                return False
+            node = node.parent
+        return True
+
+    def random_spr(self):
+        """Select a random (subtree, loc) pair for prune_and_regraft"""
+        if len(self.nodes) < 5:
+            raise PhyloNodeError("Tree too small for an SPR move")
+        while True:
+            subtree, loc = self.random_node(), self.random_node()
+            if self.can_regraft(subtree, loc):
+                return subtree, loc
+
+    def prune_and_regraft(self, subtree, loc):
+        """Subtree prune and regraft, done in place.
+        The subtree is cut off together with its parent node, the two branches
+        either side of the parent are joined, and the parent is spliced into
+        the middle of the branch above loc. Returns an Undo record of the move
+        which revert() uses to undo it exactly, so an MCMC proposal can be made
+        without copying the tree.
+        """
+        if not self.can_regraft(subtree, loc):
+            raise PhyloNodeError("Can't regraft {} onto {}".format(subtree, loc))
+        parent = subtree.parent
+        sibling = subtree.sibling
+        grandparent = parent.parent
+        index = int(parent.children[1] is subtree)
+        move = Undo(subtree, index, sibling, grandparent,
+                    parent.length, sibling.length, loc, loc.length)
+        # Prune: the sibling takes over the parent's place and branch
+        if grandparent:
+            _replace_child(grandparent, parent, sibling)
+            sibling.length = (sibling.length or 0.0) + (parent.length or 0.0)
+        else:
+            sibling.parent = None
+            sibling.length = parent.length
+            self._set_root(sibling)
+        # Regraft: the parent splits the branch above loc in two
+        regraft_parent = loc.parent
+        _replace_child(regraft_parent, loc, parent)
+        _set_children(parent, [loc, subtree])
+        parent.length = loc.length = (loc.length or 0.0) / 2
+        if self._flat is not None:
+            # Only the partials on the paths up from where the subtree was cut
+            # and where it was put back have changed
+            touched = [parent, sibling, loc, regraft_parent]
+            dirty = [parent]
+            if grandparent:
+                touched.append(grandparent)
+                dirty.append(grandparent)
+            self._flat.rewire(touched, self.root, dirty)
+        return move
+
+    def propose_spr(self):
+        """Make a random SPR move in place, returning its Undo record"""
+        return self.prune_and_regraft(*self.random_spr())
+
+    def _swap(self, node, child, sibling):
+        # child of node and sibling of node trade places
+        parent = node.parent
+        node_children = [sibling if c is child else c for c in node.children]
+        parent_children = [child if c is sibling else c for c in parent.children]
+        _set_children(node, node_children)
+        _set_children(parent, parent_children)
+        return [node, parent, child, sibling]
+
+    def nni(self, node, child):
+        """Nearest neighbour interchange across the branch above node, done in
+        place: child, one of node's children, swaps with node's sibling. Every
+        branch keeps its length, so only node and the path above it need new
+        partials. Returns a Swap record for revert().
+        """
+        if node.parent is None or child.parent is not node:
+            raise PhyloNodeError("Can't swap {} across the branch above {}".format(child, node))
+        sibling = node.sibling
+        touched = self._swap(node, child, sibling)
+        if self._flat is not None:
+            self._flat.rewire(touched, self.root, [node])
+        return Swap(node, child, sibling)
+
+    def propose_nni(self):
+        """Make a random nearest neighbour interchange in place, returning its
+        Swap record"""
+        if len(self.nodes) < 5:
+            raise PhyloNodeError("Tree too small for an NNI move")
+        while True:
+            node = self.random_node()
+            if node.children:
+                return self.nni(node, random.choice(node.children))
+
+    def revert(self, move):
+        """Undo a prune_and_regraft or nni, given the record it returned"""
+        if isinstance(move, Swap):
+            node, child, sibling = move
+            touched = self._swap(node, sibling, child)
+            if self._flat is not None:
+                self._flat.rollback(touched, self.root)
+            return self
+        subtree, index, sibling, grandparent, parent_length, sibling_length, loc, loc_length = move
+        parent = subtree.parent
+        regraft_parent = parent.parent
+        _replace_child(regraft_parent, parent, loc)
+        children = [sibling, subtree] if index else [subtree, sibling]
+        if grandparent:
+            grandchildren = [parent if c is sibling else c for c in grandparent.children]
+            _set_children(parent, children)
+            _set_children(grandparent, grandchildren)
+        else:
+            _set_children(parent, children)
+            self._set_root(parent)
+        parent.length, sibling.length, loc.length = parent_length, sibling_length, loc_length
+        if self._flat is not None:
+            touched = [parent, sibling, loc, regraft_parent] + ([grandparent] if grandparent else [])
+            self._flat.rollback(touched, self.root)
+        return self
+
+    def flatten(self):
+        """FlatTree view of this tree, cached until the topology changes"""
+        if self._flat is None:
+            self._flat = FlatTree(self.root, self.n_states, self.states, self.dtype)
+        return self._flat
+
+    def snapshot(self):
+        """Cheap snapshot of the tree's topology, branch lengths and partial
+        likelihoods as a FlatTree, instead of a copy.deepcopy of every node"""
+        return self.flatten().copy()
+
+    def get_log_likelihood(self, Q):
+        """Calculate the log likelihood of the tree on its flattened form."""
+        Q = mkmodel.as_model(Q, self.n_states)
+        return mkmodel.tree_log_likelihood(self.flatten(), Q)
+
+    def get_sites_log_likelihood(self, Q, site_states):
+        """Log likelihood of many characters at once.
+        site_states: {label: sequence of states}, one state per site.
+        """
+        Q = mkmodel.as_model(Q, max(max(s) for s in site_states.values()) + 1)
+        return mkmodel.sites_log_likelihood(self.flatten(), Q, site_states)
+
+    def get_likelihood(self, Q):
+        return math.exp(self.get_log_likelihood(Q))
+
+    def to_string(self):
+        return self.root.to_string()
+
     @property
     def leaves(self):
         return self.root.leaves
 
+    def leaf(self, label):
+        """The leaf with this label. The {label: leaf} map is built from the
+        node list on first use and kept until the tree's structure changes;
+        SPR moves rearrange branches but never the leaves themselves.
+        """
+        if self._leaves_by_label is None:
+            self._leaves_by_label = {n.label: n for n in self.nodes if not n.children}
+        try:
+            return self._leaves_by_label[label]
+        except KeyError:
+            raise PhyloNodeError("No leaf labelled {}".format(label)) from None
+
+    @property
+    def n_states(self):
+        return max(self.states.values()) + 1
+
     def __str__(self):
         info = "PhyloTree with {} nodes and {} states\n".format(
             len(self.nodes), len(set(self.states.values()))
@@ -81,7 +608,7 @@ class PhyloNode(anytree.NodeMixin):
         self.length = length
         self.label = label
         self.state = state
-        self.likelihoods = list()
+        self.likelihoods = numpy.zeros(0)
 
 
     @classmethod
@@ -91,7 +618,21 @@ class PhyloNode(anytree.NodeMixin):
         states: a dict of {label: state} where state is an integer from 0 -> n states - 1
         TODO: Move this code into the PhyloTree wrapper class
         """
-        fromnode = lambda n, p: PhyloNode(parent=p, length=n.length, label=n.name)
+        n_states = max(states.values()) + 1 if states else 0
+        def fromnode(n, p):
+            node = PhyloNode(parent=p, length=n.length, label=n.name)
+            # Preset likelihoods: likelihood for this state at this node is 1,
+            # the rest are 0. A leaf with no data gets 1s, any state is possible
+            if n.name in states:
+                node.likelihoods = numpy.zeros(n_states)
+                node.state = states[n.name]
+                node.likelihoods[node.state] = 1.0
+            elif n.descendants:
+                node.likelihoods = numpy.zeros(n_states)
+            else:
+                node.likelihoods = numpy.ones(n_states)
+            return node
+        # Nodes get their states as they are built, in the one walk
         newick_root = newick.loads(newick_str)[0]
         phylo_root = fromnode(newick_root, None)
         stack = [(newick_root, phylo_root)]
@@ -99,20 +640,6 @@ class PhyloNode(anytree.NodeMixin):
             newick_n, phylo_n = stack.pop()
             for c in newick_n.descendants:
                 stack.append( (c, fromnode(c, phylo_n)) )
-        # Attach states
-        if states:
-            n_states = max(states.values()) + 1
-            for node in anytree.PreOrderIter(phylo_root):
-                if node.label in states:
-                    this_state = states[node.label]
-                    node.state = this_state
-                    # Preset likelihoods: likelihood for this state at this node is 1,
-                    # the rest are 0
-                    likelihoods = [0 for i in range(n_states)]
-                    likelihoods[this_state] = 1
-                    node.likelihoods = likelihoods
-                else:
-                    node.likelihoods = [None for i in range(n_states)]
         return phylo_root
 
 
@@ -125,13 +652,20 @@ class PhyloNode(anytree.NodeMixin):
         self.children = [PhyloNode(children=self.children), subtree]
         return self
 
+    @property
+    def sibling(self):
+        """The other child of this node's parent. Cheaper than anytree's
+        siblings, which builds a filtered tuple, when the tree is binary."""
+        kids = self.parent.children
+        return kids[1] if kids[0] is self else kids[0]
+
     def detach(self):
         """Detach this node.
         We maintain binary structure by collapsing the remaining unary branch.
         """
         if self.is_root:
             raise PhyloNodeError("Can't detach root node")
-        sibling = self.siblings[0]
+        sibling = self.sibling
         parent = self.parent
         grandparent = parent.parent
         self.parent, parent.parent = (None, None)
@@ -142,53 +676,67 @@ class PhyloNode(anytree.NodeMixin):
             new_root = sibling
         return new_root
 
+    def to_string(self):
+        """Newick format string of the subtree from this node"""
+        built = {}
+        for n in postorder(self):
+            length = None if n is self or n.length is None else str(n.length)
+            children = [built.pop(id(c)) for c in n.children]
+            built[id(n)] = newick.Node.create(name=n.label, length=length, descendants=children)
+        return newick.dumps(built[id(self)])
+
     ## TODO: This is why I need a wrapper PhyloTree class (as well as being able to
     ## refer to root node without the hacky system above..), the wrapper can store
     ## the total number and names etc of states which are already stored in tree
-    ## TODO: Convert likelihood implementation to use the likelihood slots in the
-    ## tree. This means when the tree changes topology we don't need to recalculate
-    ## the likelihood for the whole tree, further speeding up the calculation
-    ## TODO: Use log likelihoods. This is important according to the big brains as
-    ## often the likelihood values are very small and you can have numerical problems.
-    ## Although according to https://stackoverflow.com/a/48189386 this doesn't matter
-    ## with Python (and implies with doesn't matter with any language running on modern
-    ## hardware which uses IEEE-754):
-    ## >> If the machine you are running on happens not to be using
-    ## >> IEEE-754, it is still likely that computing x/y directly will
-    ## >> produce a better result than np.exp(np.log(x)-np.log(y)). The
-    ## >> former is a single operation computing a basic function in
-    ## >> hardware that was likely reasonably designed. The latter is
-    ## >> several operations computing complicated functions in software
-    ## >> that is difficult to make accurate using common hardware
-    ## >> operations.
+    def get_log_likelihood(self, Q):
+        """Calculate the log likelihood of subtree from this node.
+        Q: the Mk rate parameter, a rate matrix, or a prebuilt mkmodel.RateModel,
+        so that callers evaluating many trees under the same Q can decompose it
+        once. See mkmodel.as_model.
+        """
+        Q = mkmodel.as_model(Q, len(self.likelihoods))
+        flat = FlatTree(self, Q.k)
+        logL = mkmodel.tree_log_likelihood(flat, Q)
+        # Leave the partial likelihoods on the nodes for inspection
+        internal = slice(flat.n_tips, None)
+        for node, likelihoods, log_scale in zip(
+            flat.nodes[internal], flat.likelihoods[internal], flat.log_scales[internal]
+        ):
+            node.likelihoods = likelihoods * numpy.exp(log_scale)
+        return logL
+
     def get_likelihood(self, Q):
         """Calculate the likelihood of subtree from this node given rate matrix Q."""
-        return mkmodel.subtree_likelihood(self, Q)
+        return math.exp(self.get_log_likelihood(Q))
     
     def equal(self, subtree):
-        """Recursive version of __eq__.
+        """Structural equality, where == is node identity.
         Return True if this tree and other tree have same nodes and topology.
+        A post-order walk together with each node's number of children pins
+        down the whole topology, so this compares the two walks position by
+        position with no recursion.
         """
-        for a, b in zip(anytree.PreOrderIter(self), anytree.PreOrderIter(subtree)):
-            if not a == b:
+        ours, theirs = postorder(self), postorder(subtree)
+        if len(ours) != len(theirs):
+            return False
+        for a, b in zip(ours, theirs):
+            if not (a.label == b.label and a.length == b.length
+                    and len(a.children) == len(b.children)):
                 return False
         return True
 
     def reverse_level_walk(self):
-        for n in reverselevelorder(self):
-            yield n
+        """Nodes of the subtree from this node in reverse level order, as a list
+        built in one go rather than a generator stepped per node"""
+        return _reverselevelorder(self)
 
     @property
     def is_binary(self):
         """Return True if this is a proper binary subtree"""
-        return all([len(n.children) == 2 for n in anytree.PreOrderIter(self) if not n.is_leaf])
-
-    def __eq__(self, node):
-        return all([
-            self.children == node.children,
-            self.label == node.label,
-            self.length == node.length
-        ])
+        for n in anytree.PreOrderIter(self):
+            if n.children and len(n.children) != 2:
+                return False
+        return True
 
     def __repr__(self):
         template = "PhyloNode({}, {}, state={}, likelihoods={})"
@@ -0,0 +1,270 @@
+import numpy
+import scipy
+
+from fulgurite._kernels import (
+    expm_batch, felsenstein_logl, mk_branch_matvec, mk_kernels_for, mk_prune, prune, prune_for,
+    prune_sites, prune_sites_levels,
+)
+from fulgurite.mkmodel import (
+    MkModel, RateModel, as_model, make_transition_matrix, combine_likelihoods, prune_levels,
+    rate_log_likelihoods, site_patterns,
+)
+from fulgurite.tree import PhyloNode, PhyloTree
+from tests.test_tree import NEWICK, TEST_TIPS, load_squamate_data
+
+
+def test_rate_model_matches_expm():
+    """Eigendecomposed P(t) should agree with the direct matrix exponential"""
+    Q = make_transition_matrix(0.3, 3)
+    model = RateModel(Q)
+    for t in [0.0, 0.5, 1.0, 2.5]:
+        assert numpy.allclose(model.P(t), scipy.linalg.expm(Q * t))
+    assert model.P(0.5) is model.P(0.5)
+
+
+def test_asymmetric_rate_model():
+    """Rate matrices that aren't symmetric go through eig and still match expm,
+    including ones with complex eigenvalues"""
+    asymmetric = numpy.array([[-0.3, 0.3], [0.8, -0.8]])
+    cyclic = numpy.array([[-1.0, 1.0, 0.0], [0.0, -1.0, 1.0], [1.0, 0.0, -1.0]])
+    for Q in [asymmetric, cyclic]:
+        model = RateModel(Q)
+        lengths = numpy.array([0.1, 0.7, 2.0])
+        expected = numpy.array([scipy.linalg.expm(Q * t) for t in lengths])
+        assert numpy.allclose(model.P_all(lengths), expected)
+        assert numpy.allclose(model.P_all(lengths, out=numpy.empty((3, len(Q), len(Q)))), expected)
+        assert numpy.allclose(model.P(0.7), expected[1])
+
+
+def expm_log_likelihood(node, Q, tips):
+    """Reference log likelihood by direct recursion, expm(Q t) @ L at each
+    branch, with no scaling and no kernels"""
+    def partials(n):
+        if not n.children:
+            return numpy.eye(len(Q))[tips[n.label]] if n.label in tips else numpy.ones(len(Q))
+        L = numpy.ones(len(Q))
+        for c in n.children:
+            L = L * (scipy.linalg.expm(Q * c.length) @ partials(c))
+        return L
+    return numpy.log(partials(node).mean())
+
+
+def test_asymmetric_likelihood():
+    """Likelihoods under rate matrices that aren't symmetric, including a
+    defective one, match the direct recursion. With no data at all the tree
+    has likelihood 1"""
+    asymmetric = numpy.array([[-0.3, 0.3], [0.8, -0.8]])
+    defective = numpy.array([[-1.0, 1.0, 0.0], [0.0, -1.0, 1.0], [0.0, 0.0, 0.0]])
+    alternating = {"A": 0, "B": 1, "C": 0, "D": 1, "E": 0, "F": 1}
+    for Q, tips in [(asymmetric, alternating), (defective, TEST_TIPS)]:
+        tree = PhyloTree.from_string(NEWICK, tips)
+        expected = expm_log_likelihood(tree.root, Q, tips)
+        assert numpy.isclose(tree.get_log_likelihood(RateModel(Q)), expected)
+        assert numpy.isclose(tree.root.get_log_likelihood(RateModel(Q)), expected)
+        site_states = {label: [state] for label, state in tips.items()}
+        assert numpy.isclose(tree.get_sites_log_likelihood(RateModel(Q), site_states), expected)
+        P = RateModel(Q).P_all(tree.flatten().lengths)
+        flat = tree.flatten()
+        L, log_scales = flat.likelihoods.copy(), flat.log_scales.copy()
+        prune_levels(P, flat.left, flat.right, flat.levels, L, log_scales)
+        assert numpy.isclose(numpy.log(L[flat.root].mean()) + log_scales[flat.root], expected)
+    missing = PhyloTree.from_string(NEWICK, {"X": 1})
+    assert numpy.isclose(missing.get_log_likelihood(RateModel(asymmetric)), 0.0)
+
+
+def test_defective_rate_model():
+    """A rate matrix with no eigenbasis goes to expm, batched over the lengths"""
+    Q = numpy.array([[-1.0, 1.0, 0.0], [0.0, -1.0, 1.0], [0.0, 0.0, 0.0]])
+    model = RateModel(Q)
+    lengths = numpy.array([0.3, 1.0, 2.0])
+    expected = numpy.array([scipy.linalg.expm(Q * t) for t in lengths])
+    assert model.defective and not RateModel(make_transition_matrix(0.3, 3)).defective
+    assert numpy.allclose(model.P_all(lengths), expected)
+    assert numpy.allclose(model.P_all(lengths, out=numpy.empty((3, 3, 3))), expected)
+    assert numpy.allclose(model.P(1.0), expected[1])
+
+
+def test_expm_batch():
+    """The compiled matrix exponential agrees with scipy's over a range of norms"""
+    rng = numpy.random.default_rng(0)
+    A = rng.normal(size=(50, 3, 3)) * rng.uniform(0, 10, (50, 1, 1))
+    assert numpy.allclose(expm_batch(A, numpy.empty_like(A)), scipy.linalg.expm(A), rtol=1e-9)
+
+
+def test_mk_model_closed_form():
+    """Closed form Mk transition probabilities match the general ones"""
+    general = RateModel(make_transition_matrix(0.4, 3))
+    mk = MkModel(0.4, 3)
+    lengths = numpy.array([0.0, 0.5, 0.8, 3.0])
+    assert numpy.allclose(mk.P(0.8), general.P(0.8))
+    assert numpy.allclose(mk.P_all(lengths), general.P_all(lengths))
+    assert numpy.allclose(general.P_all(lengths)[2], general.P(0.8))
+
+
+def test_as_model():
+    """Equal rates matrices are recognised and get the closed form model, and
+    other matrices get one RateModel per distinct Q"""
+    Q = make_transition_matrix(0.3, 3)
+    assert isinstance(as_model(Q, 3), MkModel) and as_model(Q, 3) is as_model(0.3, 3)
+    asymmetric = numpy.array([[-0.3, 0.3], [0.8, -0.8]])
+    assert type(as_model(asymmetric, 2)) is RateModel
+    assert as_model(asymmetric, 2) is as_model(asymmetric.copy(), 2)
+    tree = PhyloTree.from_string(NEWICK, TEST_TIPS)
+    assert numpy.isclose(tree.get_log_likelihood(Q), tree.get_log_likelihood(RateModel(Q)))
+
+
+def test_prune_matches_numpy():
+    """Compiled pruning kernel should agree with combine_likelihoods"""
+    model = RateModel(make_transition_matrix(0.7, 4))
+    left = PhyloNode(length=0.3)
+    right = PhyloNode(length=1.2)
+    left.likelihoods = numpy.array([0.1, 0.5, 0.2, 0.0])
+    right.likelihoods = numpy.array([0.0, 0.0, 1.0, 0.0])
+    parent = PhyloNode(children=[left, right])
+    L = numpy.array([left.likelihoods, right.likelihoods, numpy.ones(4)])
+    log_scale = numpy.zeros(3)
+    P = model.P_all([left.length, right.length, 0.0])
+    prune(P, numpy.array([-1, -1, 0]), numpy.array([-1, -1, 1]), numpy.array([2]), L, log_scale)
+    assert L[2].max() == 1.0
+    assert numpy.allclose(L[2] * numpy.exp(log_scale[2]), combine_likelihoods(parent, model))
+
+
+def assert_same_runs(expected, result, L):
+    """Run two kernels, each given as a function of the partials and log scales
+    buffers, on their own copies of L and zeroed scales, and check they leave
+    the same values in both"""
+    runs = []
+    for kernel in [expected, result]:
+        buffers = [L.copy(), numpy.zeros(L.shape[:-1])]
+        kernel(*buffers)
+        runs.append(buffers)
+    for a, b in zip(*runs):
+        assert numpy.allclose(b, a)
+
+
+def test_tip_states():
+    """Reading tips' rows of P by state agrees with multiplying out their
+    one-hot vectors, with missing tips falling back to the row of 1s"""
+    flat = load_squamate_data().flatten()
+    assert flat.tip_states.dtype == numpy.int8
+    for k in [2, 6]:
+        P = RateModel(make_transition_matrix(0.2, k)).P_all(flat.lengths)
+        states = numpy.random.default_rng(k).integers(-1, k, flat.n_tips).astype(numpy.int8)
+        L = numpy.ones((len(flat.nodes), k))
+        L[:flat.n_tips][states >= 0] = numpy.eye(k)[states[states >= 0]]
+        assert_same_runs(
+            lambda *buffers: prune_for(k)(P, flat.left, flat.right, flat.order, *buffers),
+            lambda *buffers: prune_for(k)(P, flat.left, flat.right, flat.order, *buffers, states),
+            L,
+        )
+
+
+def test_mk_branch_matvec():
+    """Matrix free Mk branch product agrees with P(t) @ L"""
+    mk = MkModel(0.4, 4)
+    L = numpy.array([0.1, 0.5, 0.2, 0.0])
+    assert numpy.allclose(mk_branch_matvec(4, 0.4, 0.8, L, numpy.empty(4)), mk.P(0.8) @ L)
+
+
+def test_felsenstein_logl():
+    """Matrix free Mk pruning and the general kernel both match tree_log_likelihood"""
+    tree = PhyloTree.from_string(NEWICK, TEST_TIPS)
+    flat = tree.flatten()
+    L = tree.get_log_likelihood(RateModel(make_transition_matrix(0.3, 3)))
+    partials, log_scales = flat.likelihoods.copy(), flat.log_scales.copy()
+    mk_prune(3, 0.3, flat.lengths, flat.left, flat.right, flat.order, partials, log_scales)
+    root = flat.root
+    assert numpy.isclose(numpy.log(partials[root].sum() / 3) + log_scales[root], L)
+    assert numpy.isclose(tree.get_log_likelihood(MkModel(0.3, 3)), L)
+    P = MkModel(0.3, 3).P_all(flat.lengths)
+    partials, log_scales = flat.likelihoods.copy(), flat.log_scales.copy()
+    logL = felsenstein_logl(P, flat.left, flat.right, flat.order, root, partials, log_scales)
+    assert numpy.isclose(logL, L)
+
+
+def test_rate_log_likelihoods():
+    """Evaluating a batch of rates at once matches evaluating them one by one"""
+    tree = load_squamate_data()
+    flat = tree.flatten()
+    rates = [0.01, 0.1, 0.5, 1.0]
+    before = flat.likelihoods.copy()
+    batch = rate_log_likelihoods(flat, rates, tree.n_states)
+    assert (flat.likelihoods == before).all()
+    assert numpy.allclose(batch, [tree.get_log_likelihood(q) for q in rates])
+
+
+def test_prune_levels():
+    """Level synchronous pruning agrees with the compiled post-order kernel"""
+    tree = PhyloTree.from_string(NEWICK, TEST_TIPS)
+    flat = tree.flatten()
+    P = RateModel(make_transition_matrix(0.3, 3)).P_all(flat.lengths)
+    levels = flat.levels
+    assert sorted(numpy.concatenate(levels)) == sorted(flat.order)
+    L, log_scales = flat.likelihoods.copy(), flat.log_scales.copy()
+    prune_levels(P, flat.left, flat.right, levels, L, log_scales)
+    expected, expected_scales = flat.likelihoods.copy(), flat.log_scales.copy()
+    prune(P, flat.left, flat.right, flat.order, expected, expected_scales)
+    assert numpy.allclose(L, expected) and numpy.allclose(log_scales, expected_scales)
+
+
+def test_sites_log_likelihood():
+    """Pruning many sites at once sums the single site log likelihoods, with
+    repeated columns counted by their weights"""
+    columns = [TEST_TIPS, {"A": 1, "B": 1, "C": 0, "D": 2, "E": 0, "F": 2}, TEST_TIPS]
+    site_states = {label: [c[label] for c in columns] for label in TEST_TIPS}
+    tree = PhyloTree.from_string(NEWICK, TEST_TIPS)
+    model = MkModel(0.3, 3)
+    patterns, weights = site_patterns(tree.flatten(), site_states)
+    assert patterns.shape == (6, 2) and sorted(weights) == [1, 2]
+    expected = sum([PhyloTree.from_string(NEWICK, c).get_log_likelihood(model) for c in columns])
+    assert numpy.isclose(tree.get_sites_log_likelihood(model, site_states), expected)
+    # A lone tip has no levels to prune, each site is just its state's 1/k
+    tip = PhyloTree.from_string("A;", {"A": 2})
+    assert numpy.isclose(tip.get_sites_log_likelihood(model, {"A": [2, 0, 1]}), 3 * numpy.log(1 / 3))
+
+
+def test_prune_sites_levels():
+    """Threaded level by level pruning agrees with the serial post-order kernel"""
+    flat = load_squamate_data().flatten()
+    rng = numpy.random.default_rng(1)
+    P = RateModel(make_transition_matrix(0.2, 4)).P_all(flat.lengths)
+    L = numpy.ones((len(flat.nodes), 7, 4))
+    states = rng.integers(0, 4, (flat.n_tips, 7))
+    L[:flat.n_tips] = numpy.eye(4)[states]
+    levels = numpy.concatenate(flat.levels)
+    bounds = numpy.cumsum([0] + [len(level) for level in flat.levels])
+    assert_same_runs(
+        lambda *buffers: prune_sites(P, flat.left, flat.right, flat.order, *buffers),
+        lambda *buffers: prune_sites_levels(P, flat.left, flat.right, levels, bounds, *buffers),
+        L,
+    )
+    # Reading tips' rows of P by state, with one tip missing at every site
+    states = states.astype(numpy.int32)
+    states[0] = -1
+    L[0] = 1.0
+    assert_same_runs(
+        lambda *buffers: prune_sites(P, flat.left, flat.right, flat.order, *buffers),
+        lambda *buffers: prune_sites_levels(P, flat.left, flat.right, levels, bounds, *buffers, states),
+        L,
+    )
+
+
+def test_specialised_kernels():
+    """Kernels compiled for a fixed number of states agree with the general ones"""
+    tree = PhyloTree.from_string(NEWICK, TEST_TIPS)
+    flat = tree.flatten()
+    for k in [3, 4, 5]:
+        model = RateModel(make_transition_matrix(0.3, k))
+        P = model.P_all(flat.lengths)
+        L = numpy.ones((len(flat.nodes), k))
+        L[:flat.n_tips] = numpy.eye(k)[[TEST_TIPS[n.label] for n in flat.nodes[:flat.n_tips]]]
+        assert_same_runs(
+            lambda *buffers: prune(P, flat.left, flat.right, flat.order, *buffers),
+            lambda *buffers: prune_for(k)(P, flat.left, flat.right, flat.order, *buffers),
+            L,
+        )
+        assert_same_runs(
+            lambda *buffers: mk_prune(k, 0.3, flat.lengths, flat.left, flat.right, flat.order, *buffers),
+            lambda *buffers: mk_kernels_for(k)[0](k, 0.3, flat.lengths, flat.left, flat.right, flat.order, *buffers),
+            L,
+        )
@@ -1,13 +1,17 @@
 import anytree
 import logging
+import math
+import numpy
 import random
 import pathlib
 import csv
 import uniplot
 
 from distutils import dir_util
-from fulgurite.tree import PhyloNode, PhyloTree, reverselevelorder
+from fulgurite.tree import PhyloNode, PhyloTree, reverselevelorder, postorder
 from fulgurite.mcmc import sample, sample_topology
+from fulgurite import mkmodel
+from fulgurite.mkmodel import MkModel
 
 
 LOGGER = logging.getLogger(__name__)
@@ -55,7 +59,7 @@ def test_tree_creation():
     tree = PhyloNode.from_string(NEWICK, states=TEST_TIPS)
     LOGGER.info("Tree with tips:\n" + str(anytree.RenderTree(tree)))
     assert tree.is_binary
-    assert all([n.state != None and n.likelihoods for n in tree.leaves])
+    assert all([n.state != None and n.likelihoods.any() for n in tree.leaves])
     
 
 def test_attach():
@@ -77,6 +81,27 @@ def test_detach():
             assert tree.is_binary
 
 
+def test_postorder():
+    tree = PhyloNode.from_string(NEWICK)
+    order = postorder(tree)
+    seen = []
+    for node in order:
+        assert all([any(c is s for s in seen) for c in node.children])
+        seen.append(node)
+    assert len(order) == len(tree.descendants) + 1 and order[-1] is tree
+
+
+def test_reverselevelorder():
+    tree = PhyloNode.from_string(NEWICK)
+    order = reverselevelorder(tree)
+    expected = list(anytree.LevelOrderIter(tree))[::-1]
+    assert len(order) == len(expected) and all([a is b for a, b in zip(order, expected)])
+    subtree = tree.children[0]
+    expected = list(anytree.LevelOrderIter(subtree))[::-1]
+    walk = subtree.reverse_level_walk()
+    assert len(walk) == len(expected) and all([a is b for a, b in zip(walk, expected)])
+
+
 def test_from_string():
     tree = PhyloNode.from_string(NEWICK)
     assert tree.is_binary
@@ -85,7 +110,8 @@ def test_from_string():
 def test_eq():
     tree1 = PhyloNode.from_string(NEWICK)
     tree2 = PhyloNode.from_string(NEWICK)
-    assert tree1.equal(tree2) and tree1 == tree2
+    assert tree1.equal(tree2) and tree1 == tree1 and tree1 != tree2
+    assert not tree1.equal(PhyloNode.from_string(SWAPPED))
 
 
 def test_likelihood():
@@ -96,18 +122,56 @@ def test_likelihood():
     LOGGER.info(anytree.RenderTree(tree))
 
 
+def test_log_likelihood():
+    """Log space pruning should agree with the plain likelihood and stay finite
+    on the large squamate tree"""
+    tree = PhyloTree.from_string(NEWICK, TEST_TIPS)
+    assert math.isclose(tree.get_log_likelihood(1), math.log(tree.get_likelihood(1)))
+    assert math.isfinite(load_squamate_data().get_log_likelihood(0.1))
+
+
+def test_missing_tip():
+    """A tip with no state counts as any state, on bare nodes as on PhyloTree"""
+    tips = {label: state for label, state in TEST_TIPS.items() if label != "A"}
+    L = PhyloTree.from_string(NEWICK, tips).get_log_likelihood(0.3)
+    assert math.isfinite(L)
+    assert math.isclose(PhyloNode.from_string(NEWICK, tips).get_log_likelihood(0.3), L)
+    assert math.isclose(PhyloNode.from_string(NEWICK, {"X": 1}).get_log_likelihood(0.3), 0.0, abs_tol=1e-12)
+
+
 def test_phylotree_creation():
     """Test wrapper class"""
     tree = PhyloTree.from_string(NEWICK, TEST_TIPS)
-    assert tree.root == PhyloNode.from_string(NEWICK)
+    assert tree.root.equal(PhyloNode.from_string(NEWICK))
     LOGGER.info(str(tree))
 
 
+def test_flatten():
+    tree = PhyloTree.from_string(NEWICK, TEST_TIPS)
+    flat = tree.flatten()
+    internal = range(flat.n_tips, len(flat.nodes))
+    assert all([flat.left[i] < i and flat.right[i] < i for i in internal])
+    assert flat.nodes[-1] is tree.root and flat.parent[-1] == -1
+    for i, node in enumerate(flat.nodes[:flat.n_tips]):
+        assert flat.tip_states[i] == TEST_TIPS[node.label]
+        assert flat.likelihoods[i].argmax() == TEST_TIPS[node.label] and flat.likelihoods[i].sum() == 1
+    assert round(tree.get_likelihood(1), 4) == 0.0015
+
+
+def test_float32():
+    """Single precision partials should stay close to the float64 results"""
+    tree = load_squamate_data()
+    single = PhyloTree.from_string(tree.to_string(), tree.states, dtype=numpy.float32)
+    assert single.flatten().likelihoods.dtype == numpy.float32
+    for model in [MkModel(0.1, 2), mkmodel.RateModel(mkmodel.make_transition_matrix(0.1, 2))]:
+        assert math.isclose(single.get_log_likelihood(model), tree.get_log_likelihood(model), rel_tol=1e-5)
+
+
 def test_mcmc():
     tree = PhyloTree.from_string(NEWICK, TEST_TIPS)
-    qposterior, qlikelihood = sample(tree, 4000)
+    qposterior, qloglikelihood = sample(tree, 4000)
     pmean = sum(qposterior) / len(qposterior)
-    lmean = sum(qlikelihood) / len(qlikelihood)
+    lmean = sum([math.exp(l) for l in qloglikelihood]) / len(qloglikelihood)
     LOGGER.info("P = {}, L = {}".format(pmean, lmean))
     # Show a plot of the posterior trace in log output
     plot = uniplot.plot(
@@ -121,7 +185,144 @@ def test_mcmc():
     assert round(lmean, 4) == 0.0015
     
 
-# def test_topology_sampler():
-#     tree = PhyloTree.from_string(NEWICK, TEST_TIPS)
-#     trees, l = sample_topology(tree, 10)
-#     LOGGER.info("\n".join(trees))
+def test_node_list():
+    """PhyloTree's node list should follow attach and detach"""
+    tree = PhyloTree.from_string(NEWICK, TEST_TIPS)
+    subtree, loc = tree.leaf("C"), tree.leaf("F")
+    assert subtree.label == "C" and subtree in tree.leaves
+    tree.detach(subtree)
+    assert sorted(map(id, tree.nodes)) == sorted(map(id, postorder(tree.root)))
+    assert id(subtree) not in tree.node_ids and id(loc) in tree.node_ids
+    tree.attach(subtree, loc)
+    assert sorted(map(id, tree.nodes)) == sorted(map(id, postorder(tree.root)))
+    assert tree.node_ids == set(map(id, postorder(tree.root)))
+    assert tree.leaf("C") is subtree
+    assert tree.is_binary
+
+
+def test_prune_and_regraft():
+    """Every SPR move should keep the tree binary and be exactly reversible"""
+    tree = PhyloTree.from_string(NEWICK, TEST_TIPS)
+    original, L = tree.to_string(), tree.get_log_likelihood(1)
+    for subtree in tree.nodes:
+        for loc in tree.nodes:
+            if not tree.can_regraft(subtree, loc):
+                continue
+            move = tree.prune_and_regraft(subtree, loc)
+            assert tree.root.is_binary and len(postorder(tree.root)) == len(tree.nodes)
+            assert all([c.parent is n for n in postorder(tree.root) for c in n.children])
+            assert tree.to_string() != original
+            assert math.isclose(tree.get_log_likelihood(1), tree.root.get_log_likelihood(1))
+            assert tree.nodes[0] is tree.root
+            tree.revert(move)
+            assert tree.to_string() == original
+    assert math.isclose(tree.get_log_likelihood(1), L)
+
+
+def test_nni():
+    """Every NNI move should keep the tree binary, update the likelihood along
+    the one path it changes, and be exactly reversible"""
+    tree = load_squamate_data()
+    model = MkModel(0.2, tree.n_states)
+    original, L = tree.to_string(), tree.get_log_likelihood(model)
+    flat = tree.flatten()
+    for node in tree.nodes[1:40]:
+        for child in node.children:
+            move = tree.nni(node, child)
+            assert child.parent is node.parent and move.sibling.parent is node
+            assert set(flat.pending) == {flat.rows[id(n)] for n in node.iter_path_reverse()}
+            assert math.isclose(tree.get_log_likelihood(model), tree.root.get_log_likelihood(model))
+            tree.revert(move)
+            assert tree.to_string() == original
+    assert math.isclose(tree.get_log_likelihood(model), L)
+    for i in range(20):
+        tree.propose_nni()
+    assert tree.root.is_binary and len(postorder(tree.root)) == len(tree.nodes)
+    assert math.isclose(tree.get_log_likelihood(model), tree.root.get_log_likelihood(model))
+
+
+def test_incremental_likelihood():
+    """Likelihoods updated along the changed paths should match a full pass"""
+    tree = load_squamate_data()
+    model = MkModel(0.2, tree.n_states)
+    tree.get_log_likelihood(model)
+    for i in range(50):
+        move = tree.propose_spr()
+        if random.random() < 0.8:
+            L = tree.get_log_likelihood(model)
+            assert math.isclose(L, tree.root.get_log_likelihood(model))
+        if random.random() < 0.5:
+            tree.revert(move)
+    assert math.isclose(tree.get_log_likelihood(model), tree.root.get_log_likelihood(model))
+
+
+def test_shared_rate_model():
+    """Evaluating at the same rate twice reuses the model, so the second
+    evaluation after a move only has the changed paths to redo"""
+    tree = load_squamate_data()
+    L = tree.get_log_likelihood(0.2)
+    flat = tree.flatten()
+    assert flat.model is mkmodel.mk_model(0.2, tree.n_states)
+    move = tree.propose_spr()
+    assert 0 < len(flat.pending) < len(flat.order)
+    assert math.isclose(tree.get_log_likelihood(0.2), tree.root.get_log_likelihood(0.2))
+    tree.revert(move)
+    assert math.isclose(tree.get_log_likelihood(0.2), L)
+
+
+def test_revert_in_sequence():
+    """Moves can be undone newest first, several in a row, with or without
+    evaluating in between, and the likelihood still matches a full pass"""
+    tree = load_squamate_data()
+    model = MkModel(0.2, tree.n_states)
+    original, L = tree.to_string(), tree.get_log_likelihood(model)
+    for evaluate in [False, True]:
+        moves = []
+        for propose in [tree.propose_spr, tree.propose_nni, tree.propose_spr]:
+            moves.append(propose())
+            if evaluate:
+                tree.get_log_likelihood(model)
+        for move in reversed(moves):
+            tree.revert(move)
+            assert math.isclose(tree.get_log_likelihood(model), tree.root.get_log_likelihood(model))
+        assert tree.to_string() == original
+        assert math.isclose(tree.get_log_likelihood(model), L)
+
+
+def test_dirty_paths():
+    """An SPR move should only mark the paths from the move up to the root, and
+    evaluating should leave every other row as it was"""
+    tree = load_squamate_data()
+    model = MkModel(0.2, tree.n_states)
+    flat = tree.flatten()
+    for i in range(20):
+        tree.get_log_likelihood(model)
+        before = flat.likelihoods.copy()
+        subtree, loc = tree.random_spr()
+        sibling = subtree.siblings[0]
+        tree.prune_and_regraft(subtree, loc)
+        on_path = set()
+        for node in (subtree.parent, sibling.parent or sibling):
+            on_path.update(flat.rows[id(n)] for n in node.iter_path_reverse())
+        assert set(flat.pending) <= on_path
+        tree.get_log_likelihood(model)
+        untouched = [i for i in range(len(flat.nodes)) if i not in on_path]
+        assert (flat.likelihoods[untouched] == before[untouched]).all()
+
+
+def test_snapshot():
+    """A snapshot keeps the likelihood of the tree it was taken from"""
+    tree = PhyloTree.from_string(NEWICK, TEST_TIPS)
+    model = MkModel(1, tree.n_states)
+    L = tree.get_log_likelihood(model)
+    snapshot = tree.snapshot()
+    tree.prune_and_regraft(*tree.random_spr())
+    tree.get_log_likelihood(model)
+    assert math.isclose(mkmodel.tree_log_likelihood(snapshot, MkModel(1, tree.n_states)), L)
+
+
+def test_topology_sampler():
+    tree = PhyloTree.from_string(NEWICK, TEST_TIPS)
+    trees, l = sample_topology(tree, 10)
+    LOGGER.info("\n".join(trees))
+    assert len(trees) == len(l) == 10 and tree.to_string() == trees[-1]